@@ -1,157 +1,446 @@
 import sqlite3
-import requests
+import asyncio
+import aiohttp
 import time
-from datetime import datetime
 import signal
-import sys
 import logging
-from threading import Event, Thread
+import queue
+import atexit
+from threading import Thread, Lock
 from collections import defaultdict
 
-logging.basicConfig(level=logging.INFO,
-                   format='%(asctime)s - %(levelname)s - %(message)s')
+DB_PATH = 'sensor_data.db'
+
+def connect_db(read_only=False, **kwargs):
+    """Open sensor_data.db with the per-connection settings shared by every caller."""
+    # journal_mode=WAL persists in the file; these pragmas must be set on each connection
+    if read_only:
+        conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, timeout=5, **kwargs)
+    else:
+        conn = sqlite3.connect(DB_PATH, timeout=5, **kwargs)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+# Columns added to devices after its first release, as (name, definition)
+NEW_DEVICE_COLUMNS = (
+    ('humidity_control', 'INTEGER DEFAULT 0'),
+    ('humidity_threshold', 'REAL DEFAULT 0.0'),
+    ('humidity_on_time', 'INTEGER DEFAULT 300'),
+    ('humidity_cooldown', 'INTEGER DEFAULT 600'),
+)
+
+def init_db():
+    """Create sensor_data.db or bring its schema up to date; safe to run on every start."""
+    conn = connect_db()
+    try:
+        c = conn.cursor()
+        # Lets the collector's retention job hand freed pages back to the filesystem. It only
+        # takes effect on a new database; existing files need a one-off VACUUM to switch.
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL lets the dashboard read while the collector writes; the mode persists in the file
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute('''CREATE TABLE IF NOT EXISTS devices
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      name TEXT UNIQUE,
+                      url TEXT,
+                      hostname TEXT,
+                      reading_frequency INTEGER DEFAULT 60)''')
+        existing = {column[1] for column in c.execute("PRAGMA table_info(devices)")}
+        for column, definition in NEW_DEVICE_COLUMNS:
+            if column not in existing:
+                c.execute(f"ALTER TABLE devices ADD COLUMN {column} {definition}")
+        readings_columns = '''(timestamp INTEGER,
+                                device_id INTEGER,
+                                temperature REAL,
+                                humidity REAL,
+                                FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE)'''
+        c.execute(f"CREATE TABLE IF NOT EXISTS readings {readings_columns}")
+        # Schema version 1: timestamps are Unix epoch seconds instead of local-time ISO text
+        if c.execute("PRAGMA user_version").fetchone()[0] < 1:
+            c.execute("""UPDATE readings
+                         SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+                         WHERE typeof(timestamp) = 'text'""")
+            c.execute("PRAGMA user_version = 1")
+        # Schema version 2: readings go with their device. SQLite can't alter a foreign
+        # key, so older tables are rebuilt (dropping readings already orphaned)
+        if c.execute("PRAGMA user_version").fetchone()[0] < 2:
+            if not any(fk[6] == 'CASCADE' for fk in c.execute("PRAGMA foreign_key_list(readings)")):
+                c.execute("DELETE FROM readings WHERE device_id NOT IN (SELECT id FROM devices)")
+                c.execute("ALTER TABLE readings RENAME TO readings_old")
+                c.execute(f"CREATE TABLE readings {readings_columns}")
+                c.execute("INSERT INTO readings SELECT * FROM readings_old")
+                c.execute("DROP TABLE readings_old")
+            c.execute("PRAGMA user_version = 2")
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_readings_device_time
+                     ON readings(device_id, timestamp)''')
+        conn.commit()
+        logging.info("Database initialized successfully")
+    except Exception:
+        logging.exception("Database initialization failed")
+        raise
+    finally:
+        conn.close()
+
+# Failures expected from an unreachable or misbehaving device; anything else is a bug
+HTTP_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError)
 
 class DeviceCollector:
+    # Rows still queued for a device that was just removed are skipped rather than
+    # failing the whole batch on the foreign key
+    INSERT_READING = """INSERT INTO readings SELECT ?1, ?2, ?3, ?4
+                        WHERE EXISTS (SELECT 1 FROM devices WHERE id = ?2)"""
+    SELECT_SETTINGS = """SELECT humidity_control, humidity_threshold,
+                         humidity_on_time, humidity_cooldown
+                         FROM devices WHERE id = ?"""
+    # Old readings are deleted in small batches so queued inserts never wait long
+    DELETE_OLD_READINGS = """DELETE FROM readings WHERE rowid IN
+                             (SELECT rowid FROM readings WHERE timestamp < ? LIMIT ?)"""
+    # The Arduino firmware reads the relay state from the query string and the ESP-IDF
+    # firmware from the body, which it matches byte for byte, so both are sent
+    RELAY_BODIES = {"on": b'{"state":"on"}', "off": b'{"state":"off"}'}
+    SETTINGS_TTL = 60
+    WRITE_BATCH_SIZE = 100
+    WRITE_BATCH_WINDOW = 1.0
+    WRITE_QUEUE_SIZE = 10000
+    RETENTION_DAYS = 30
+    PRUNE_INTERVAL = 24 * 3600
+    PRUNE_BATCH_SIZE = 5000
+
     def __init__(self):
         self.collectors = {}
-        self.stop_flags = defaultdict(Event)
-        self.main_stop_flag = Event()
+        self.device_configs = {}
+        self.stop_flags = {}
+        self.main_stop_flag = asyncio.Event()
         self.last_activation = defaultdict(int)
         self.timer_states = defaultdict(lambda: {"last_switch": 0, "current_state": "off"})
-        
-    def get_sensor_data(self, base_url):
+        # device_id -> most recent valid sensor payload, plus the 'time' it was read
+        self.latest = {}
+        # device_id -> timer configuration from the last poll; dropped when that poll fails
+        self.timer_configs = {}
+        # Devices that have had at least one poll attempt, successful or not
+        self.polled = set()
+        # device_id -> pending task that switches the humidity relay back off
+        self.off_timers = {}
+        # Device URLs whose firmware predates /api/state
+        self.legacy_firmware = set()
+        # device_id -> (settings row, monotonic time fetched); refreshed every SETTINGS_TTL
+        self.settings_cache = {}
+        # Event loop, shared keep-alive HTTP client and read connection, all created by _main()
+        self.loop = None
+        self.session = None
+        self.read_conn = None
+        # Readings are persisted in batches by _writer_loop; None asks it to flush and exit
+        self.write_q = queue.Queue(maxsize=self.WRITE_QUEUE_SIZE)
+
+    async def get_sensor_data(self, base_url):
         try:
-            response = requests.get(f"{base_url}/api/sensor")
-            return response.json()
-        except:
+            async with self.session.get(f"{base_url}/api/sensor") as response:
+                return await response.json(content_type=None)
+        except HTTP_ERRORS:
             return None
 
-    def set_relay_state(self, base_url, state):
+    async def set_relay_state(self, base_url, state):
         try:
-            response = requests.post(f"{base_url}/api/relay", params={"state": state})
-            return response.json()
-        except:
+            async with self.session.post(f"{base_url}/api/relay", params={"state": state},
+                                         data=self.RELAY_BODIES[state],
+                                         headers={'Content-Type': 'application/json'}) as response:
+                return await response.json(content_type=None)
+        except HTTP_ERRORS:
             return None
 
     def store_reading(self, device_id, temperature, humidity):
-        conn = sqlite3.connect('sensor_data.db')
-        c = conn.cursor()
-        c.execute("INSERT INTO readings VALUES (?, ?, ?, ?)",
-                  (datetime.now(), device_id, temperature, humidity))
-        conn.commit()
-        conn.close()
+        # Called on the event loop, so never block; if the database stalls long enough to
+        # fill the queue, drop the reading rather than grow without bound
+        try:
+            self.write_q.put_nowait((int(time.time()), device_id, temperature, humidity))
+        except queue.Full:
+            logging.warning("Write queue full, dropping reading for device %s", device_id)
 
-    def get_timer_config(self, base_url):
+    def _writer_loop(self):
+        # The only connection that writes; everything else reads through read_conn
+        conn = connect_db(isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        running = True
+        next_prune = time.monotonic()
         try:
-            response = requests.get(f"{base_url}/api/timer")
-            return response.json()
-        except:
+            while running:
+                if time.monotonic() >= next_prune:
+                    self._prune_readings(conn)
+                    next_prune = time.monotonic() + self.PRUNE_INTERVAL
+                rows = []
+                deadline = time.monotonic() + self.WRITE_BATCH_WINDOW
+                while len(rows) < self.WRITE_BATCH_SIZE:
+                    try:
+                        row = self.write_q.get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if row is None:
+                        running = False
+                        break
+                    rows.append(row)
+                if not rows:
+                    continue
+                try:
+                    conn.execute("BEGIN")
+                    conn.executemany(self.INSERT_READING, rows)
+                    conn.execute("COMMIT")
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    logging.error("Failed to store %s readings: %s", len(rows), e)
+        finally:
+            conn.close()
+
+    def _prune_readings(self, conn):
+        """Delete readings older than RETENTION_DAYS and release the freed pages to the filesystem."""
+        cutoff = int(time.time()) - self.RETENTION_DAYS * 86400
+        deleted = 0
+        try:
+            while True:
+                conn.execute("BEGIN")
+                count = conn.execute(self.DELETE_OLD_READINGS, (cutoff, self.PRUNE_BATCH_SIZE)).rowcount
+                conn.execute("COMMIT")
+                deleted += count
+                if count < self.PRUNE_BATCH_SIZE:
+                    break
+            # incremental_vacuum frees one page per step; executescript runs it to completion
+            conn.executescript("PRAGMA incremental_vacuum;")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            if deleted:
+                logging.info("Pruned %s readings older than %s days", deleted, self.RETENTION_DAYS)
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            logging.error("Failed to prune old readings: %s", e)
+
+    async def get_timer_config(self, base_url):
+        try:
+            async with self.session.get(f"{base_url}/api/timer") as response:
+                return await response.json(content_type=None)
+        except HTTP_ERRORS:
             return None
 
-    def collect_device_data(self, device_id, device_url, frequency):
-        conn = sqlite3.connect('sensor_data.db')
-        c = conn.cursor()
-        
+    async def get_device_state(self, base_url):
+        """Fetch sensor data and timer config in one request, falling back to
+        separate (concurrent) requests for firmware without /api/state."""
+        if base_url not in self.legacy_firmware:
+            try:
+                async with self.session.get(f"{base_url}/api/state") as response:
+                    if response.status != 404:
+                        return await response.json(content_type=None)
+                self.legacy_firmware.add(base_url)
+            except HTTP_ERRORS:
+                return None
+        sensor, timer_config = await asyncio.gather(self.get_sensor_data(base_url),
+                                                    self.get_timer_config(base_url))
+        return {"sensor": sensor, "timer": timer_config}
+
+    async def _wait(self, event, timeout):
+        """Sleep up to `timeout` seconds; return True as soon as `event` is set."""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def get_device_settings(self, device_id):
+        now = time.monotonic()
+        cached = self.settings_cache.get(device_id)
+        if cached and now - cached[1] < self.SETTINGS_TTL:
+            return cached[0]
+        settings = self.read_conn.execute(self.SELECT_SETTINGS, (device_id,)).fetchone()
+        self.settings_cache[device_id] = (settings, now)
+        return settings
+
+    async def collect_device_data(self, device_id, device_url, frequency):
         while not self.stop_flags[device_id].is_set() and not self.main_stop_flag.is_set():
             try:
                 # Get device settings
-                c.execute("""SELECT humidity_control, humidity_threshold, 
-                           humidity_on_time, humidity_cooldown 
-                           FROM devices WHERE id = ?""", (device_id,))
-                settings = c.fetchone()
-                
-                # Get timer configuration
-                timer_config = self.get_timer_config(device_url)
+                settings = self.get_device_settings(device_id)
+
+                # Get sensor data and timer configuration
+                state = await self.get_device_state(device_url) or {}
+                timer_config = state.get('timer')
+                data = state.get('sensor')
                 current_time = time.time()
-                
+
+                self.polled.add(device_id)
+                if data and 'error' not in data:
+                    self.latest[device_id] = dict(data, time=current_time)
+                if timer_config:
+                    self.timer_configs[device_id] = timer_config
+                else:
+                    self.timer_configs.pop(device_id, None)
+
                 # Handle timer control
                 if timer_config and timer_config.get('enabled'):
                     timer_state = self.timer_states[device_id]
                     on_duration = timer_config.get('onDuration', 0)
                     off_duration = timer_config.get('offDuration', 0)
-                    
+
                     if timer_state["current_state"] == "off" and current_time - timer_state["last_switch"] >= off_duration:
-                        self.set_relay_state(device_url, "on")
+                        await self.set_relay_state(device_url, "on")
                         timer_state["current_state"] = "on"
                         timer_state["last_switch"] = current_time
-                        logging.info(f"Timer turned ON device {device_id}")
+                        logging.info("Timer turned ON device %s", device_id)
                     elif timer_state["current_state"] == "on" and current_time - timer_state["last_switch"] >= on_duration:
-                        self.set_relay_state(device_url, "off")
+                        await self.set_relay_state(device_url, "off")
                         timer_state["current_state"] = "off"
                         timer_state["last_switch"] = current_time
-                        logging.info(f"Timer turned OFF device {device_id}")
-                
-                # Handle humidity control only if timer is not enabled
-                elif settings and settings[0] and not (timer_config and timer_config.get('enabled')):
-                    humidity_control, threshold, on_time, cooldown = settings
-                    data = self.get_sensor_data(device_url)
-                    
-                    if data and 'error' not in data:
-                        self.store_reading(device_id, data['temperature'], data['humidity'])
-                        
+                        logging.info("Timer turned OFF device %s", device_id)
+
+                # Store the reading and handle humidity control only if timer is not enabled
+                elif data and 'error' not in data:
+                    self.store_reading(device_id, data['temperature'], data['humidity'])
+
+                    if settings and settings[0]:
+                        humidity_control, threshold, on_time, cooldown = settings
                         if (data['humidity'] < threshold and 
-                            current_time - self.last_activation[device_id] >= cooldown):
-                            self.set_relay_state(device_url, "on")
-                            logging.info(f"Turned ON device {device_id} due to humidity {data['humidity']} below {threshold}")
-                            time.sleep(on_time)
-                            self.set_relay_state(device_url, "off")
+                            current_time - self.last_activation[device_id] >= cooldown and
+                            device_id not in self.off_timers):
+                            await self.set_relay_state(device_url, "on")
+                            logging.info("Turned ON device %s due to humidity %s below %s",
+                                         device_id, data['humidity'], threshold)
                             self.last_activation[device_id] = current_time
-                            logging.info(f"Turned OFF device {device_id} after {on_time} seconds")
-                
-                # Get sensor data even if no control is active
-                if not (timer_config and timer_config.get('enabled')):
-                    data = self.get_sensor_data(device_url)
-                    if data and 'error' not in data:
-                        self.store_reading(device_id, data['temperature'], data['humidity'])
-                
+                            # Keep polling during the on window; the OFF is sent by a separate task
+                            self.off_timers[device_id] = asyncio.create_task(
+                                self._turn_off_after(device_id, device_url, on_time)
+                            )
+
             except Exception as e:
-                logging.error(f"Error in device control loop for device {device_id}: {e}")
-            
-            time.sleep(frequency)
-        
-        conn.close()
+                logging.error("Error in device control loop for device %s: %s", device_id, e)
+
+            if await self._wait(self.stop_flags[device_id], frequency):
+                break
+
+    async def _turn_off_after(self, device_id, device_url, on_time):
+        try:
+            await asyncio.sleep(on_time)
+        finally:
+            # Also runs when cancelled on shutdown so the relay is never left on
+            await self.set_relay_state(device_url, "off")
+            self.off_timers.pop(device_id, None)
+            logging.info("Turned OFF device %s after %s seconds", device_id, on_time)
 
     def start_collector(self, device_id, device_url, frequency):
+        # Replacing a collector only cancels the old task; it never blocks the refresh pass
         if device_id in self.collectors:
             self.stop_flags[device_id].set()
-            self.collectors[device_id].join()
-        
-        self.stop_flags[device_id].clear()
-        collector = Thread(
-            target=self.collect_device_data,
-            args=(device_id, device_url, frequency)
+            self.collectors[device_id].cancel()
+
+        self.stop_flags[device_id] = asyncio.Event()
+        self.device_configs[device_id] = (device_url, frequency)
+        self.collectors[device_id] = asyncio.create_task(
+            self.collect_device_data(device_id, device_url, frequency)
         )
-        collector.daemon = True
-        collector.start()
-        self.collectors[device_id] = collector
+
+    def remove_collector(self, device_id):
+        # A pending humidity OFF task is left to finish and removes itself
+        self.stop_flags.pop(device_id).set()
+        self.collectors.pop(device_id).cancel()
+        for state in (self.device_configs, self.last_activation, self.timer_states,
+                      self.settings_cache, self.latest, self.timer_configs):
+            state.pop(device_id, None)
+        self.polled.discard(device_id)
 
     def get_active_devices(self):
-        conn = sqlite3.connect('sensor_data.db')
-        c = conn.cursor()
-        c.execute("SELECT id, url, reading_frequency FROM devices")
-        devices = c.fetchall()
-        conn.close()
-        return devices
-
-    def run(self):
-        def signal_handler(signum, frame):
-            logging.info("Stopping collector service...")
-            self.main_stop_flag.set()
-            for device_id in list(self.collectors.keys()):
-                self.stop_flags[device_id].set()
-            sys.exit(0)
-
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
-
-        while not self.main_stop_flag.is_set():
-            devices = self.get_active_devices()
-            for device_id, url, frequency in devices:
-                if device_id not in self.collectors:
-                    logging.info(f"Starting collector for device {device_id}")
-                    self.start_collector(device_id, url, frequency)
-            time.sleep(10)  # Check for new devices every 10 seconds
+        return self.read_conn.execute("SELECT id, url, reading_frequency FROM devices").fetchall()
+
+    def stop(self):
+        """Ask the collector to shut down; safe to call from any thread."""
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop)
+
+    def _stop(self):
+        logging.info("Stopping collector service...")
+        self.main_stop_flag.set()
+        for device_id in list(self.collectors.keys()):
+            self.stop_flags[device_id].set()
+
+    async def _main(self, handle_signals=True):
+        self.loop = asyncio.get_running_loop()
+        if handle_signals:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self.loop.add_signal_handler(signum, self._stop)
+
+        self.read_conn = connect_db(read_only=True)
+        writer = Thread(target=self._writer_loop, daemon=True)
+        writer.start()
+        try:
+            connector = aiohttp.TCPConnector(limit=64, keepalive_timeout=30)
+            timeout = aiohttp.ClientTimeout(total=5, connect=2)
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                self.session = session
+                while not self.main_stop_flag.is_set():
+                    # A failed refresh (e.g. the database locked past the busy timeout) keeps
+                    # the running collectors and is retried on the next pass
+                    try:
+                        devices = self.get_active_devices()
+                        for device_id in set(self.collectors) - {d[0] for d in devices}:
+                            logging.info("Stopping collector for removed device %s", device_id)
+                            self.remove_collector(device_id)
+                        for device_id, url, frequency in devices:
+                            if device_id not in self.collectors:
+                                logging.info("Starting collector for device %s", device_id)
+                                self.start_collector(device_id, url, frequency)
+                            elif self.device_configs[device_id] != (url, frequency):
+                                logging.info("Restarting collector for device %s", device_id)
+                                self.start_collector(device_id, url, frequency)
+                    except Exception as e:
+                        logging.error("Error refreshing the device list: %s", e)
+                    # Check for new devices every 10 seconds
+                    if await self._wait(self.main_stop_flag, 10):
+                        break
+
+                tasks = list(self.collectors.values()) + list(self.off_timers.values())
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # The queue is bounded: wait for room only while the writer can still drain it
+            while writer.is_alive():
+                try:
+                    self.write_q.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+            writer.join()
+            self.read_conn.close()
+
+    def run(self, handle_signals=True):
+        # Signal handlers can only be installed when running on the main thread
+        asyncio.run(self._main(handle_signals))
+
+# The collector an embedding process (the dashboard) runs in the background. Kept at
+# module level so it survives Streamlit reruns and cache clears: a second instance
+# would switch the same relays and store every reading twice.
+_background_collector = None
+_background_lock = Lock()
+
+def get_collector():
+    """Return the process-wide background collector, starting it on the first call."""
+    global _background_collector
+    with _background_lock:
+        if _background_collector is None:
+            collector = DeviceCollector()
+            thread = Thread(target=collector.run, kwargs={'handle_signals': False}, daemon=True)
+            thread.start()
+
+            # Flushes readings still queued for the batch writer
+            def cleanup():
+                collector.stop()
+                thread.join(timeout=5)
+            atexit.register(cleanup)
+            _background_collector = collector
+        return _background_collector
 
 if __name__ == "__main__":
+    # Configured only when run standalone; the dashboard sets up its own handlers
+    logging.basicConfig(level=logging.INFO,
+                       format='%(asctime)s - %(levelname)s - %(message)s')
+    init_db()
     collector = DeviceCollector()
     collector.run()
@@ -1,83 +1,116 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import sqlite3
 from datetime import datetime
+from dateutil import tz
 import time
-import plotly.express as px
+import plotly.graph_objects as go
 import json
 import threading
-from queue import Queue
-import asyncio, aiohttp
-from collections import defaultdict
+from collections import namedtuple
 import os
+import atexit
+import hmac
+import secrets
 from streamlit_cookies_controller import CookieController
 import logging
-import traceback
+from logging.handlers import RotatingFileHandler
+from collector_service import connect_db, init_db, get_collector
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('dashboard.log'),
+        # Keeps at most ~20 MB of logs: the current file plus three rotated ones
+        RotatingFileHandler('dashboard.log', maxBytes=5_000_000, backupCount=3),
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
 
-# Enhanced database setup
-def init_db():
-    try:
-        conn = sqlite3.connect('sensor_data.db')
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS devices
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      name TEXT UNIQUE,
-                      url TEXT,
-                      hostname TEXT,
-                      reading_frequency INTEGER DEFAULT 60)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS readings
-                     (timestamp DATETIME,
-                      device_id INTEGER,
-                      temperature REAL,
-                      humidity REAL,
-                      FOREIGN KEY(device_id) REFERENCES devices(id))''')
-        # Add new columns for humidity control
-        c.execute('''ALTER TABLE devices ADD COLUMN humidity_control INTEGER DEFAULT 0''')
-        c.execute('''ALTER TABLE devices ADD COLUMN humidity_threshold REAL DEFAULT 0.0''')
-        c.execute('''ALTER TABLE devices ADD COLUMN humidity_on_time INTEGER DEFAULT 300''')
-        c.execute('''ALTER TABLE devices ADD COLUMN humidity_cooldown INTEGER DEFAULT 600''')
-        conn.commit()
-        logger.info("Database initialized successfully")
-    except sqlite3.OperationalError as e:
-        if 'duplicate column' not in str(e):
-            raise
-    except Exception as e:
-        logger.error(f"Database initialization failed: {str(e)}\n{traceback.format_exc()}")
-        raise
-    finally:
-        conn.close()
+# (connect, read) timeout in seconds for every device request
+HTTP_TIMEOUT = (2, 5)
+
+# The relay only has two states, so its request bodies are built once
+RELAY_PAYLOADS = {state: json.dumps({"state": state}, separators=(',', ':')).encode()
+                  for state in ("on", "off")}
+
+# Shared across reruns and sessions so requests to a device reuse keep-alive connections
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    session.headers.update({'User-Agent': 'ESP-LabNode-dashboard', 'Connection': 'keep-alive'})
+    # A failed connect is retried once for any method, since the request never reached
+    # the device; read errors and error statuses are not, so a POST is never sent twice
+    retry = Retry(connect=1, read=0, status=0, other=0, backoff_factor=0.1)
+    session.mount('http://', HTTPAdapter(max_retries=retry, pool_connections=32, pool_maxsize=32))
+    return session
+
+# Read-only connection shared by the cached query helpers
+@st.cache_resource
+def get_read_conn():
+    conn = connect_db(read_only=True, check_same_thread=False)
+    atexit.register(conn.close)
+    return conn
+
+# Writable connection shared across reruns. Streamlit serves sessions from several
+# threads, so writers hold get_write_lock() and use the connection as a transaction
+# context manager, which commits on success and rolls back on error.
+@st.cache_resource
+def get_conn():
+    conn = connect_db(check_same_thread=False)
+    atexit.register(conn.close)
+    return conn
+
+@st.cache_resource
+def get_write_lock():
+    return threading.Lock()
+
+# A device whose newest reading is older than this many polling intervals is shown as offline
+STALE_READING_POLLS = 3
+
+# Target number of points per historical chart
+HISTORY_POINTS = 500
+# Every window runs this exact text, so the connection's statement cache reuses one prepared query
+HISTORY_QUERY = """
+SELECT timestamp / :bucket * :bucket AS timestamp,
+       AVG(temperature) AS temperature,
+       AVG(humidity) AS humidity
+FROM readings
+WHERE device_id = :device_id
+AND timestamp >= :since
+GROUP BY 1
+ORDER BY 1
+"""
+
+# Readings are stored as Unix epoch seconds; charts show the server's local time,
+# following its DST rules like datetime.fromtimestamp does
+LOCAL_TZ = tz.tzlocal()
+
+def to_local_datetime(epoch_seconds):
+    return pd.to_datetime(epoch_seconds, unit='s', utc=True).dt.tz_convert(LOCAL_TZ).dt.tz_localize(None)
 
 # Enhanced API interaction functions
 def get_sensor_data(base_url):
     try:
-        headers = {'Connection': 'close'}
-        response = requests.get(
+        response = get_session().get(
             f"{base_url}/api/sensor",
-            headers=headers,
-            timeout=5.0
+            timeout=HTTP_TIMEOUT
         )
         response.raise_for_status()
         return response.json()
     except requests.exceptions.Timeout:
-        logger.error(f"Timeout getting sensor data from {base_url}")
+        logger.error("Timeout getting sensor data from %s", base_url)
         return None
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to get sensor data from {base_url}: {str(e)}")
+        logger.error("Failed to get sensor data from %s: %s", base_url, e)
         return None
     except ValueError as e:
-        logger.error(f"Invalid JSON response from {base_url}: {str(e)}")
+        logger.error("Invalid JSON response from %s: %s", base_url, e)
         return None
 
 def set_relay_state(base_url, state):
@@ -85,220 +118,288 @@ def set_relay_state(base_url, state):
         headers = {
             'Content-Type': 'application/json',
         }
-        data = f'{{"state":"{state}"}}'  # Format JSON string properly
-        
-        response = requests.post(
+        response = get_session().post(
             f"{base_url}/api/relay",
             headers=headers,
-            data=data,  # Use data instead of params
-            timeout=5.0
+            data=RELAY_PAYLOADS[state],
+            timeout=HTTP_TIMEOUT
         )
         response.raise_for_status()
-        logger.info(f"Relay state set to {state} for {base_url}")
+        logger.info("Relay state set to %s for %s", state, base_url)
         return response.json()
     except requests.exceptions.Timeout:
-        logger.error(f"Timeout setting relay state for {base_url}")
+        logger.error("Timeout setting relay state for %s", base_url)
         return None
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to set relay state for {base_url}: {str(e)}")
+        logger.error("Failed to set relay state for %s: %s", base_url, e)
         return None
     except ValueError as e:
-        logger.error(f"Invalid JSON response from {base_url}: {str(e)}")
-        return None
-
-async def set_relay_state_async(base_url, state):
-    try:
-        headers = {
-            'Content-Type': 'application/json',
-        }
-        data = f'{{"state":"{state}"}}'
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{base_url}/api/relay",
-                headers=headers,
-                data=data,
-                timeout=2.0
-            ) as response:
-                response.raise_for_status()
-                result = await response.json()
-                logger.info(f"Relay state set to {state} for {base_url}")
-                return result
-    except Exception as e:
-        logger.error(f"Failed to set relay state for {base_url}: {str(e)}")
+        logger.error("Invalid JSON response from %s: %s", base_url, e)
         return None
 
 def get_timer_config(base_url):
     try:
-        response = requests.get(f"{base_url}/api/timer")
+        response = get_session().get(f"{base_url}/api/timer", timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to get timer config from {base_url}: {str(e)}")
+        logger.error("Failed to get timer config from %s: %s", base_url, e)
         return None
 
 def set_timer_config(base_url, config):
     try:
-        response = requests.post(f"{base_url}/api/timer", json=config)
+        response = get_session().post(f"{base_url}/api/timer", json=config, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to set timer config for {base_url}: {str(e)}")
+        logger.error("Failed to set timer config for %s: %s", base_url, e)
         return None
 
 def get_hostname(base_url):
     try:
-        response = requests.get(f"{base_url}/api/hostname")
+        response = get_session().get(f"{base_url}/api/hostname", timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to get hostname from {base_url}: {str(e)}")
+        logger.error("Failed to get hostname from %s: %s", base_url, e)
         return None
 
 def set_hostname(base_url, hostname):
     try:
-        response = requests.post(f"{base_url}/api/hostname", json={"hostname": hostname})
+        response = get_session().post(f"{base_url}/api/hostname", json={"hostname": hostname}, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to set hostname for {base_url}: {str(e)}")
+        logger.error("Failed to set hostname for %s: %s", base_url, e)
         return None
 
 # Enhanced device management functions
 def add_device(name, url):
-    conn = None
     try:
-        conn = sqlite3.connect('sensor_data.db')
-        c = conn.cursor()
         hostname_info = get_hostname(url)
         hostname = hostname_info.get('hostname', 'unknown') if hostname_info else 'unknown'
-        c.execute("INSERT INTO devices (name, url, hostname) VALUES (?, ?, ?)",
-                 (name, url, hostname))
-        conn.commit()
-        logger.info(f"Added new device: {name} ({url})")
+        with get_write_lock(), get_conn() as conn:
+            conn.execute("INSERT INTO devices (name, url, hostname) VALUES (?, ?, ?)",
+                         (name, url, hostname))
+        get_devices.clear()
+        logger.info("Added new device: %s (%s)", name, url)
         return True
     except sqlite3.IntegrityError as e:
-        logger.warning(f"Failed to add device - duplicate name: {name}")
+        logger.warning("Failed to add device - duplicate name: %s", name)
         return False
-    except Exception as e:
-        logger.error(f"Error adding device {name}: {str(e)}\n{traceback.format_exc()}")
+    except Exception:
+        logger.exception("Error adding device %s", name)
         return False
-    finally:
-        if conn:
-            conn.close()
 
 def remove_device(device_id):
-    conn = sqlite3.connect('sensor_data.db')
-    c = conn.cursor()
     try:
-        c.execute("DELETE FROM devices WHERE id = ?", (device_id,))
-        c.execute("DELETE FROM readings WHERE device_id = ?", (device_id,))
-        conn.commit()
-        logger.info(f"Removed device with ID: {device_id}")
-    except Exception as e:
-        logger.error(f"Error removing device {device_id}: {str(e)}\n{traceback.format_exc()}")
-    finally:
-        conn.close()
-
+        with get_write_lock(), get_conn() as conn:
+            # ON DELETE CASCADE removes the device's readings in the same statement
+            conn.execute("DELETE FROM devices WHERE id = ?", (device_id,))
+        get_devices.clear()
+        get_historical_data.clear()
+        get_history_figure.clear()
+        logger.info("Removed device with ID: %s", device_id)
+    except Exception:
+        logger.exception("Error removing device %s", device_id)
+
+Device = namedtuple('Device', 'id name url hostname reading_frequency humidity_control '
+                               'humidity_threshold humidity_on_time humidity_cooldown')
+
+@st.cache_data(ttl=60)
 def get_devices():
-    conn = sqlite3.connect('sensor_data.db')
     try:
-        df = pd.read_sql_query("SELECT * FROM devices", conn)
-        return df
-    except Exception as e:
-        logger.error(f"Error fetching devices: {str(e)}\n{traceback.format_exc()}")
-        return pd.DataFrame()
-    finally:
-        conn.close()
+        rows = get_read_conn().execute(f"SELECT {', '.join(Device._fields)} FROM devices").fetchall()
+        return [Device(*row) for row in rows]
+    except Exception:
+        logger.exception("Error fetching devices")
+        return []
 
 # Add new functions for reading frequency management
 def update_device_frequency(device_id, frequency):
-    conn = sqlite3.connect('sensor_data.db')
-    c = conn.cursor()
     try:
-        c.execute("UPDATE devices SET reading_frequency = ? WHERE id = ?", (frequency, device_id))
-        conn.commit()
-        logger.info(f"Updated reading frequency for device ID {device_id} to {frequency} seconds")
-    except Exception as e:
-        logger.error(f"Error updating reading frequency for device ID {device_id}: {str(e)}\n{traceback.format_exc()}")
-    finally:
-        conn.close()
+        with get_write_lock(), get_conn() as conn:
+            conn.execute("UPDATE devices SET reading_frequency = ? WHERE id = ?", (frequency, device_id))
+        get_devices.clear()
+        logger.info("Updated reading frequency for device ID %s to %s seconds", device_id, frequency)
+    except Exception:
+        logger.exception("Error updating reading frequency for device ID %s", device_id)
 
 # Add new functions for humidity control settings
 def update_humidity_settings(device_id, enabled, threshold, on_time, cooldown):
-    conn = sqlite3.connect('sensor_data.db')
-    c = conn.cursor()
     try:
-        c.execute("""UPDATE devices 
-                     SET humidity_control = ?, 
-                         humidity_threshold = ?,
-                         humidity_on_time = ?,
-                         humidity_cooldown = ?
-                     WHERE id = ?""", 
-                 (enabled, threshold, on_time, cooldown, device_id))
-        conn.commit()
-        logger.info(f"Updated humidity settings for device ID {device_id}")
+        with get_write_lock(), get_conn() as conn:
+            conn.execute("""UPDATE devices 
+                            SET humidity_control = ?, 
+                                humidity_threshold = ?,
+                                humidity_on_time = ?,
+                                humidity_cooldown = ?
+                            WHERE id = ?""", 
+                         (enabled, threshold, on_time, cooldown, device_id))
+        get_devices.clear()
+        logger.info("Updated humidity settings for device ID %s", device_id)
     except Exception as e:
-        logger.error(f"Error updating humidity settings: {str(e)}")
-    finally:
-        conn.close()
-
-# Data storage
-def store_reading(device_id, temperature, humidity):
-    conn = sqlite3.connect('sensor_data.db')
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO readings VALUES (?, ?, ?, ?)",
-                  (datetime.now(), device_id, temperature, humidity))
-        conn.commit()
-        logger.info(f"Stored reading for device ID {device_id}: temp={temperature}°C, humidity={humidity}%")
-    except Exception as e:
-        logger.error(f"Error storing reading for device ID {device_id}: {str(e)}\n{traceback.format_exc()}")
-    finally:
-        conn.close()
+        logger.error("Error updating humidity settings: %s", e)
 
-def get_historical_data(device_id, hours=24):
-    conn = sqlite3.connect('sensor_data.db')
+# last_ts (the device's newest reading) is only part of the cache key, so cached
+# history and figures are replaced as soon as a new reading is stored
+@st.cache_data(ttl=600, max_entries=64)
+def get_historical_data(device_id, hours=24, last_ts=None):
     try:
-        query = f"""
-        SELECT timestamp, temperature, humidity 
-        FROM readings 
-        WHERE device_id = ?
-        AND timestamp >= datetime('now', '-{hours} hours')
-        """
-        df = pd.read_sql_query(query, conn, params=(device_id,), parse_dates=['timestamp'])
+        # Average readings into fixed-width buckets so the chart gets ~HISTORY_POINTS
+        # points regardless of the time window (never finer than one minute)
+        hours = int(hours)
+        bucket = max(60, hours * 3600 // HISTORY_POINTS)
+        rows = get_read_conn().execute(HISTORY_QUERY, {'bucket': bucket, 'device_id': device_id,
+                                                       'since': int(time.time()) - hours * 3600}).fetchall()
+        df = pd.DataFrame(rows, columns=['timestamp', 'temperature', 'humidity'])
+        df = df.astype({'temperature': 'float32', 'humidity': 'float32'})
+        if not rows:
+            return df
+        df['timestamp'] = to_local_datetime(df['timestamp'])
         return df
-    except Exception as e:
-        logger.error(f"Error fetching historical data for device ID {device_id}: {str(e)}\n{traceback.format_exc()}")
+    except Exception:
+        logger.exception("Error fetching historical data for device ID %s", device_id)
         return pd.DataFrame()
-    finally:
-        conn.close()
+
+# Figures are shared across reruns and sessions for as long as the data they draw
+@st.cache_resource(ttl=600, max_entries=64)
+def get_history_figure(device_id, hours, last_ts=None):
+    """Build the history chart for a device, or return None when there is nothing to plot."""
+    df = get_historical_data(device_id, hours, last_ts)
+    if df.empty:
+        return None
+    # Temperature and humidity share one WebGL figure on separate y axes
+    fig = go.Figure()
+    fig.add_trace(go.Scattergl(x=df['timestamp'], y=df['temperature'],
+                               mode='lines', name='Temperature (°C)',
+                               line_color='#1e88e5'))
+    fig.add_trace(go.Scattergl(x=df['timestamp'], y=df['humidity'],
+                               mode='lines', name='Humidity (%)',
+                               line_color='#43a047', yaxis='y2'))
+    fig.update_layout(
+        title='Temperature & Humidity History',
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        xaxis_gridcolor='#f0f2f6',
+        yaxis=dict(title='Temperature (°C)', gridcolor='#f0f2f6'),
+        yaxis2=dict(title='Humidity (%)', overlaying='y', side='right',
+                    showgrid=False),
+        legend=dict(orientation='h', y=-0.15)
+    )
+    return fig
 
 def get_available_time_range(device_id):
-    conn = sqlite3.connect('sensor_data.db')
     try:
+        # Separate subqueries let each aggregate read a single entry from the
+        # (device_id, timestamp) index; MIN and MAX together scan the device's whole range
         query = """
         SELECT 
-            MIN(timestamp) as first_reading,
-            MAX(timestamp) as last_reading
-        FROM readings 
-        WHERE device_id = ?
+            (SELECT MIN(timestamp) FROM readings WHERE device_id = :device_id) as first_reading,
+            (SELECT MAX(timestamp) FROM readings WHERE device_id = :device_id) as last_reading
         """
-        df = pd.read_sql_query(query, conn, params=(device_id,), parse_dates=['first_reading', 'last_reading'])
-        if df.empty or pd.isnull(df['first_reading'].iloc[0]):
+        first_reading, last_reading = get_read_conn().execute(query, {'device_id': device_id}).fetchone()
+        if first_reading is None:
             return None, None
-        return df['first_reading'].iloc[0], df['last_reading'].iloc[0]
-    except Exception as e:
-        logger.error(f"Error fetching time range for device ID {device_id}: {str(e)}\n{traceback.format_exc()}")
+        return datetime.fromtimestamp(first_reading), datetime.fromtimestamp(last_reading)
+    except Exception:
+        logger.exception("Error fetching time range for device ID %s", device_id)
         return None, None
-    finally:
-        conn.close()
+
+# Fragment so pressing a relay button reruns only these controls
+@st.fragment
+def show_manual_control(device_url):
+    st.markdown("#### Manual Control")
+    control_cols_inner = st.columns(2)
+
+    # Add session state for button loading states
+    if 'button_loading' not in st.session_state:
+        st.session_state.button_loading = False
+
+    with control_cols_inner[0]:
+        if st.button("🟢 Turn ON", 
+                    use_container_width=True, 
+                    disabled=st.session_state.button_loading):
+            placeholder = st.empty()
+            placeholder.info("Turning ON...")
+            st.session_state.button_loading = True
+            result = set_relay_state(device_url, "on")
+            if result:
+                placeholder.success("Device turned ON")
+            else:
+                placeholder.error("Failed to turn device ON")
+            st.session_state.button_loading = False
+
+    with control_cols_inner[1]:
+        if st.button("🔴 Turn OFF", 
+                    use_container_width=True,
+                    disabled=st.session_state.button_loading):
+            placeholder = st.empty()
+            placeholder.info("Turning OFF...")
+            st.session_state.button_loading = True
+            result = set_relay_state(device_url, "off")
+            if result:
+                placeholder.success("Device turned OFF")
+            else:
+                placeholder.error("Failed to turn device OFF")
+            st.session_state.button_loading = False
+
+# Fragment so changing the time range redraws the chart without rerunning the page
+@st.fragment
+def show_history(device_id):
+    # Historical data with improved visuals
+    st.markdown("### 📈 Historical Data")
+
+    # Get available time range
+    first_reading, last_reading = get_available_time_range(device_id)
+
+    if first_reading is None:
+        st.info("No historical data available for this device")
+    else:
+        # Calculate the total hours of available data
+        total_hours = (last_reading - first_reading).total_seconds() / 3600
+
+        # Create dynamic time options based on available data
+        time_options = []
+        for hours in [6, 12, 24, 48, 72]:
+            if hours <= total_hours:
+                time_options.append(f"Last {hours} hours")
+        time_options.append("All data")
+
+        if not time_options:
+            time_options = ["All data"]
+
+        selected_time = st.select_slider(
+            "Time Range",
+            options=time_options,
+            value=time_options[-1]
+        )
+
+        with st.spinner('Loading historical data...'):
+            # Get the number of hours for the query
+            if selected_time == "All data":
+                hours = int(total_hours) + 1
+            else:
+                hours = int(selected_time.split()[1])
+
+            fig = get_history_figure(device_id, hours, last_reading)
+            if fig is not None:
+                st.plotly_chart(fig, use_container_width=True)
+            else:
+                st.info("📊 No data available for the selected time range")
 
 def show_dashboard_page(selected_device):
     # Create a container for better spacing
     main_container = st.container()
     
     with main_container:
+        # The collector keeps a device's last good reading; once it is this many polls
+        # old the device is treated as offline
+        data = get_collector().latest.get(selected_device.id)
+        frequency = selected_device.reading_frequency or 60
+        if data and time.time() - data['time'] > STALE_READING_POLLS * frequency:
+            data = None
+
         # Header with device status
         col1, col2 = st.columns([3, 1])
         with col1:
@@ -308,7 +409,7 @@ def show_dashboard_page(selected_device):
                 f"""
                 <div style='background-color: #f0f2f6; padding: 1rem; border-radius: 0.5rem; text-align: center;'>
                     <small>Device Status</small><br/>
-                    <span style='color: #00c853; font-size: 1.2em;'>●</span> Online
+                    <span style='color: {"#00c853" if data else "#e53935"}; font-size: 1.2em;'>●</span> {"Online" if data else "Offline"}
                 </div>
                 """,
                 unsafe_allow_html=True
@@ -317,11 +418,8 @@ def show_dashboard_page(selected_device):
         # Current readings in modern cards
         st.markdown("### 📌 Current Status")
         metric_cols = st.columns(2)
-        
-        with st.spinner('Fetching current readings...'):
-            data = get_sensor_data(selected_device.url)
-            
-        if data and 'error' not in data:
+
+        if data:
             with metric_cols[0]:
                 st.markdown(
                     f"""
@@ -342,7 +440,7 @@ def show_dashboard_page(selected_device):
                     """,
                     unsafe_allow_html=True
                 )
-            store_reading(selected_device.id, data['temperature'], data['humidity'])
+            st.caption(f"Last reading: {datetime.fromtimestamp(data['time']):%Y-%m-%d %H:%M:%S}")
         else:
             st.error("📡 Unable to fetch current readings. Please check device connection.")
 
@@ -351,44 +449,15 @@ def show_dashboard_page(selected_device):
         control_cols = st.columns([2, 3])
         
         with control_cols[0]:
-            st.markdown("#### Manual Control")
-            control_cols_inner = st.columns(2)
-            
-            # Add session state for button loading states
-            if 'button_loading' not in st.session_state:
-                st.session_state.button_loading = False
-            
-            with control_cols_inner[0]:
-                if st.button("🟢 Turn ON", 
-                            use_container_width=True, 
-                            disabled=st.session_state.button_loading):
-                    placeholder = st.empty()
-                    placeholder.info("Turning ON...")
-                    st.session_state.button_loading = True
-                    result = set_relay_state(selected_device.url, "on")
-                    if result:
-                        placeholder.success("Device turned ON")
-                    else:
-                        placeholder.error("Failed to turn device ON")
-                    st.session_state.button_loading = False
-                    
-            with control_cols_inner[1]:
-                if st.button("🔴 Turn OFF", 
-                            use_container_width=True,
-                            disabled=st.session_state.button_loading):
-                    placeholder = st.empty()
-                    placeholder.info("Turning OFF...")
-                    st.session_state.button_loading = True
-                    result = set_relay_state(selected_device.url, "off")
-                    if result:
-                        placeholder.success("Device turned OFF")
-                    else:
-                        placeholder.error("Failed to turn device OFF")
-                    st.session_state.button_loading = False
+            show_manual_control(selected_device.url)
 
         with control_cols[1]:
             st.markdown("#### Timer Settings")
-            timer_data = get_timer_config(selected_device.url)
+            # The collector already polls the timer config; only ask the device before its first poll
+            collector = get_collector()
+            timer_data = collector.timer_configs.get(selected_device.id)
+            if timer_data is None and selected_device.id not in collector.polled:
+                timer_data = get_timer_config(selected_device.url)
             if timer_data:
                 timer_cols = st.columns([1, 2, 2])
                 with timer_cols[0]:
@@ -405,6 +474,8 @@ def show_dashboard_page(selected_device):
                                                  min_value=0,
                                                  max_value=86400,  # 24 hours
                                                  step=5)
+            else:
+                st.warning("Timer settings unavailable")
 
         # Add after the Timer Settings section
         with control_cols[1]:
@@ -441,94 +512,55 @@ def show_dashboard_page(selected_device):
                                         cooldown)
                     st.success("Humidity settings updated successfully")
 
-        # Historical data with improved visuals
-        st.markdown("### 📈 Historical Data")
-        
-        # Get available time range
-        first_reading, last_reading = get_available_time_range(selected_device.id)
-        
-        if first_reading is None:
-            st.info("No historical data available for this device")
-        else:
-            # Calculate the total hours of available data
-            total_hours = (last_reading - first_reading).total_seconds() / 3600
-            
-            # Create dynamic time options based on available data
-            time_options = []
-            for hours in [6, 12, 24, 48, 72]:
-                if hours <= total_hours:
-                    time_options.append(f"Last {hours} hours")
-            time_options.append("All data")
-            
-            if not time_options:
-                time_options = ["All data"]
-            
-            selected_time = st.select_slider(
-                "Time Range",
-                options=time_options,
-                value=time_options[-1]
-            )
-            
-            with st.spinner('Loading historical data...'):
-                # Get the number of hours for the query
-                if selected_time == "All data":
-                    hours = int(total_hours) + 1
-                else:
-                    hours = int(selected_time.split()[1])
-                    
-                df = get_historical_data(selected_device.id, hours)
-                
-                if not df.empty:
-                    # Temperature chart
-                    fig1 = px.line(df, x='timestamp', y='temperature',
-                                title='Temperature History')
-                    fig1.update_traces(line_color='#1e88e5')
-                    fig1.update_layout(
-                        plot_bgcolor='white',
-                        paper_bgcolor='white',
-                        xaxis_gridcolor='#f0f2f6',
-                        yaxis_gridcolor='#f0f2f6'
-                    )
-                    st.plotly_chart(fig1, use_container_width=True)
-                    
-                    # Humidity chart
-                    fig2 = px.line(df, x='timestamp', y='humidity',
-                                title='Humidity History')
-                    fig2.update_traces(line_color='#43a047')
-                    fig2.update_layout(
-                        plot_bgcolor='white',
-                        paper_bgcolor='white',
-                        xaxis_gridcolor='#f0f2f6',
-                        yaxis_gridcolor='#f0f2f6'
-                    )
-                    st.plotly_chart(fig2, use_container_width=True)
-                else:
-                    st.info("📊 No data available for the selected time range")
-
-# Initialize database and collector outside of main()
-init_db()
-
-# Register a cleanup handler
-def cleanup():
-    pass
-import atexit
-atexit.register(cleanup)
+        show_history(selected_device.id)
+
+# Streamlit re-executes this module on every rerun; set up the schema once per process
+@st.cache_resource
+def init_db_once():
+    init_db()
+
+init_db_once()
+# One collector per server process polls every device and persists readings; the
+# dashboard shows its latest values instead of querying devices itself
+get_collector()
+
+# Generated on first start when GUI_SECRET isn't set; only the server can read it
+AUTH_SECRET_PATH = '.auth_secret'
+
+@st.cache_resource
+def get_auth_secret():
+    """Key for the auth cookie: GUI_SECRET if set, otherwise one random key per install."""
+    secret = os.environ.get("GUI_SECRET")
+    if secret:
+        return secret.encode()
+    if not os.path.exists(AUTH_SECRET_PATH):
+        fd = os.open(AUTH_SECRET_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secrets.token_bytes(32))
+    with open(AUTH_SECRET_PATH, 'rb') as f:
+        return f.read()
+
+# Dashboard password, read once per script run
+_PW = os.environ.get("GUI_PW", "").encode()
+# The cookie carries an HMAC of the password under the server's secret key, so it can't
+# be checked against password guesses without that key
+_AUTH_TOKEN = hmac.new(get_auth_secret(), _PW, 'blake2b').hexdigest().encode()
 
 def check_password():
     """Returns `True` if the user had the correct password."""
     controller = CookieController()
     
-    # Check if already authenticated via cookie
+    # Check if already authenticated via cookie (constant-time to avoid a timing oracle)
     auth_cookie = controller.get('auth_token')
-    if auth_cookie == os.environ.get("GUI_PW"):
+    if auth_cookie is not None and hmac.compare_digest(str(auth_cookie).encode(), _AUTH_TOKEN):
         return True
     
     def password_entered():
         """Checks whether a password entered by the user is correct."""
-        if "password" in st.session_state and st.session_state["password"] == os.environ.get("GUI_PW"):
+        if "password" in st.session_state and hmac.compare_digest(st.session_state["password"].encode(), _PW):
             st.session_state["password_correct"] = True
             # Set authentication cookie
-            controller.set('auth_token', os.environ.get("GUI_PW"))
+            controller.set('auth_token', _AUTH_TOKEN.decode())
             del st.session_state["password"]
         else:
             st.session_state["password_correct"] = False
@@ -555,7 +587,7 @@ def main():
     try:
         st.set_page_config(page_title="Temperature Control Dashboard", layout="wide")
         
-        if not os.environ.get("GUI_PW"):
+        if not _PW:
             logger.error("Environment variable GUI_PW not set!")
             st.error("Environment variable GUI_PW not set!")
             return
@@ -567,6 +599,7 @@ def main():
         if st.sidebar.button("Logout"):
             controller = CookieController()
             controller.remove('auth_token')
+            st.cache_data.clear()
             st.rerun()
 
         # Sidebar device management
@@ -584,13 +617,13 @@ def main():
         
         # Device selection
         devices = get_devices()
-        if len(devices) == 0:
+        if not devices:
             st.sidebar.warning("No devices configured")
             return
             
         selected_device = st.sidebar.selectbox(
             "Select Device",
-            devices.itertuples(),
+            devices,
             format_func=lambda x: x.name
         )
         
@@ -613,8 +646,8 @@ def main():
         # Show dashboard content
         show_dashboard_page(selected_device)
 
-    except Exception as e:
-        logger.error(f"Unhandled exception in main: {str(e)}\n{traceback.format_exc()}")
+    except Exception:
+        logger.exception("Unhandled exception in main")
         st.error("An unexpected error occurred. Please check the logs for details.")
 
 if __name__ == "__main__":
@@ -95,6 +95,7 @@ static void initialize_wifi(void);
 static esp_err_t sensor_get_handler(httpd_req_t *req);
 static esp_err_t relay_post_handler(httpd_req_t *req);
 static esp_err_t timer_handler(httpd_req_t *req);
+static esp_err_t state_get_handler(httpd_req_t *req);
 static esp_err_t hostname_get_handler(httpd_req_t *req);
 static esp_err_t hostname_post_handler(httpd_req_t *req);
 static void timer_control_task(void *pvParameters);
@@ -148,6 +149,14 @@ static const httpd_uri_t timer_post_uri = {    // Added new URI for POST
     .user_ctx  = NULL
 };
 
+// Sensor reading and timer config in a single round trip
+static const httpd_uri_t state_uri = {
+    .uri       = "/api/state",
+    .method    = HTTP_GET,
+    .handler   = state_get_handler,
+    .user_ctx  = NULL
+};
+
 // Add new URI handlers
 static const httpd_uri_t hostname_get_uri = {
     .uri       = "/api/hostname",
@@ -185,7 +194,9 @@ static const httpd_uri_t wifi_uri = {
 // Start HTTP server
 static httpd_handle_t start_webserver(void) {
     httpd_config_t config = HTTPD_DEFAULT_CONFIG();
-    
+    // Clients keep connections alive; recycle the oldest socket instead of refusing new ones
+    config.lru_purge_enable = true;
+
     if (httpd_start(&server, &config) == ESP_OK) {
         if (is_ap_mode) {
             // AP mode handlers
@@ -198,6 +209,7 @@ static httpd_handle_t start_webserver(void) {
             httpd_register_uri_handler(server, &relay_uri);
             httpd_register_uri_handler(server, &timer_uri);        // Register GET handler
             httpd_register_uri_handler(server, &timer_post_uri);   // Register POST handler
+            httpd_register_uri_handler(server, &state_uri);
             httpd_register_uri_handler(server, &hostname_get_uri);
             httpd_register_uri_handler(server, &hostname_post_uri);
         }
@@ -529,30 +541,59 @@ static esp_err_t read_sensor_safe(float *temperature, float *humidity) {
     return ESP_OK;
 }
 
-// Update the sensor_get_handler to include better error reporting
-static esp_err_t sensor_get_handler(httpd_req_t *req) {
+// Format the sensor reading (or error) as JSON; shared by /api/sensor and /api/state
+static void format_sensor_json(char *buffer, size_t size) {
     float temperature = 0, humidity = 0;
     esp_err_t ret = read_sensor_safe(&temperature, &humidity);
     
-    char response[100];
     if (ret == ESP_OK) {
-        create_json_response(response, sizeof(response), 
+        create_json_response(buffer, size, 
             "{\"temperature\":%.1f,\"humidity\":%.1f,\"status\":\"ok\"}", 
             temperature, humidity);
     } else {
         const char* error_msg = (ret == ESP_ERR_NOT_FOUND) ? 
             "Sensor not connected" : "Failed to read sensor";
         
-        create_json_response(response, sizeof(response), 
+        create_json_response(buffer, size, 
             "{\"error\":\"%s\",\"status\":\"error\",\"code\":%d}", 
             error_msg, ret);
     }
+}
+
+// Format the timer configuration as JSON; shared by /api/timer and /api/state
+static void format_timer_json(char *buffer, size_t size) {
+    create_json_response(buffer, size,
+        "{\"enabled\":%s,\"onDuration\":%u,\"offDuration\":%u,\"currentState\":%s}",
+        relay_timer.enabled ? "true" : "false",
+        relay_timer.on_duration / 1000,
+        relay_timer.off_duration / 1000,
+        relay_timer.current_state ? "true" : "false");
+}
+
+// Update the sensor_get_handler to include better error reporting
+static esp_err_t sensor_get_handler(httpd_req_t *req) {
+    char response[100];
+    format_sensor_json(response, sizeof(response));
     
     httpd_resp_set_type(req, "application/json");
     httpd_resp_send(req, response, strlen(response));
     return ESP_OK;
 }
 
+static esp_err_t state_get_handler(httpd_req_t *req) {
+    char sensor[100];
+    char timer[200];
+    char response[320];
+    format_sensor_json(sensor, sizeof(sensor));
+    format_timer_json(timer, sizeof(timer));
+    create_json_response(response, sizeof(response),
+        "{\"sensor\":%s,\"timer\":%s}", sensor, timer);
+    
+    httpd_resp_set_type(req, "application/json");
+    httpd_resp_sendstr(req, response);
+    return ESP_OK;
+}
+
 static esp_err_t relay_post_handler(httpd_req_t *req) {
     char buf[100];
     char response[100];
@@ -614,12 +655,7 @@ static esp_err_t relay_post_handler(httpd_req_t *req) {
 static esp_err_t timer_handler(httpd_req_t *req) {
     if (req->method == HTTP_GET) {
         char response[200];
-        create_json_response(response, sizeof(response),
-            "{\"enabled\":%s,\"onDuration\":%u,\"offDuration\":%u,\"currentState\":%s}",
-            relay_timer.enabled ? "true" : "false",
-            relay_timer.on_duration / 1000,
-            relay_timer.off_duration / 1000,
-            relay_timer.current_state ? "true" : "false");
+        format_timer_json(response, sizeof(response));
         
         httpd_resp_set_type(req, "application/json");
         httpd_resp_sendstr(req, response);